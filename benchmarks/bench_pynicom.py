@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Pynicom benchmark suite
+
+Drive the pynicom shell against a scripted modem responder running on a Linux
+pty pair and measure command round trip latency, RX throughput, dictionary
+load time, completion latency, NMEA checksum and CMUX throughput. Results are
+written as JSON, so that they can be compared between releases.
+
+Usage:
+    bench_pynicom.py [-d|--debug] [--output=output] [--compare=baseline] [--timeout=timeout] [--rounds=rounds] [--lines=lines] [--no-echo]
+
+Options:
+    --output=output       JSON file where to write the results [default: bench_output.json]
+    --compare=baseline    JSON results of a previous run to compare with
+    --timeout=timeout     serial read timeout in seconds [default: 0.05]
+    --rounds=rounds       repetitions of each measure [default: 20]
+    --lines=lines         lines streamed by the responder for the RX measure [default: 5000]
+    --no-echo             the responder does not echo the commands, as after ATE0
+"""
+
+import json
+import logging
+import os
+import platform
+import pty
+import sys
+import threading
+import time
+import tty
+
+from docopt import docopt
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+import pynicom  # noqa: E402
+
+NMEA_SENTENCE = "GNRMC,115725.000,A,3913.6604,N,00904.1282,E,0.00,51.50,060715,,,D"
+STREAM_CMD = "AT#BENCHSTREAM"
+SINK_CMD = "AT#BENCHSINK"
+DICTIONARY_SIZES = [100, 1000, 10000]
+NMEA_CHECKSUM = pynicom.Pynicom()._Pynicom__nmea_checksum(NMEA_SENTENCE)
+
+
+class ScriptedResponder(threading.Thread):
+    """
+    A fake modem on the master side of a pty pair. It echoes every command
+    (unless echo is False, as after ATE0) and answers with the scripted
+    response (or OK), each line framed by <CR><LF> as in V.25ter.
+    AT#BENCHSTREAM=<n> makes it stream n NMEA sentences, AT#BENCHSINK is
+    silently discarded.
+    """
+
+    def __init__(self, script, echo=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.script = script
+        self.echo = echo
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def run(self):
+        pending = b""
+        while True:
+            try:
+                pending += os.read(self.master, 4096)
+            except OSError:
+                return
+
+            while b"\r" in pending:
+                line, pending = pending.split(b"\r", 1)
+                self.answer(line.decode().strip())
+
+    def answer(self, cmd):
+        if cmd.upper().startswith(STREAM_CMD + "="):
+            line = ("$%s*%s\r\n" % (NMEA_SENTENCE, NMEA_CHECKSUM)).encode()
+            self.write(line * int(cmd.split("=")[1]))
+            return
+
+        if cmd.upper() == SINK_CMD:
+            return
+
+        response = self.script.get(cmd.upper(), ["OK"])
+        echo = cmd + "\r" if self.echo else ""
+        self.write((echo + "".join("\r\n%s\r\n" % line for line in response)).encode())
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.master, data) :]
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def new_shell(port, timeout):
+    shell = pynicom.Pynicom()
+    shell.quiet = True
+    # serial_open positional args: port baudrate ... timeout
+    shell.do_serial_open(" ".join([port, "115200", "", "", "", "", "", "", str(timeout)]))
+    return shell
+
+
+def run_cmd(shell, line):
+    shell.postcmd(shell.onecmd(line), line)
+
+
+def measure(func, rounds):
+    """Run func rounds times, return the list of elapsed times"""
+    elapsed = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return elapsed
+
+
+def result(value, unit):
+    return {"value": value, "unit": unit}
+
+
+def bench_round_trip(shell, rounds):
+    """
+    Command round trip: from the command to the arrival of its final result
+    code, without the empty reads that make serial_read return.
+    """
+    elapsed = []
+    for _ in range(rounds):
+        start = time.time()
+        run_cmd(shell, "AT+GMR")
+        elapsed.append(shell.last_result_time - start)
+    elapsed.sort()
+    return {
+        "round_trip_median": result(elapsed[len(elapsed) // 2], "s"),
+        "round_trip_max": result(elapsed[-1], "s"),
+    }
+
+
+def bench_serial_write(shell, rounds):
+    count = 1000
+    elapsed = min(
+        measure(lambda: [shell.serial_write(SINK_CMD) for _ in range(count)], rounds)
+    )
+    shell.toread = False
+    return {"serial_write_rate": result(count / elapsed, "cmd/s")}
+
+
+def bench_rx(shell, lines, timeout):
+    """
+    Stream lines through serial_read. The zero reads that end serial_read are
+    not part of the throughput.
+    """
+    line_len = len(NMEA_SENTENCE) + len("$*XX\r\n")
+    shell.serial_write("%s=%d" % (STREAM_CMD, lines))
+    start = time.perf_counter()
+    shell.do_serial_read("")
+    elapsed = time.perf_counter() - start - 3 * timeout
+    shell.toread = False
+
+    received = len(shell.last_response)
+    if received != lines:
+        pynicom.LOGW("RX benchmark got %d lines out of %d", received, lines)
+    return {
+        "rx_lines_rate": result(received / elapsed, "lines/s"),
+        "rx_bytes_rate": result(received * line_len / elapsed, "B/s"),
+    }
+
+
+def dictionary_lines(size):
+    return [
+        "AT+BENCH%05d        # AT+BENCH%05d=<n> Benchmark command %d\n" % (i, i, i)
+        for i in range(size)
+    ]
+
+
+def bench_dictionary(rounds):
+    results = {}
+    for size in DICTIONARY_SIZES:
+        lines = dictionary_lines(size)
+
+        def load():
+            commands = pynicom.get_commands(lines, {})
+            pynicom.add_do_command(commands, type("Shell", (pynicom.Pynicom,), {}))
+
+        results["dictionary_load_%d" % size] = result(min(measure(load, rounds)), "s")
+    return results
+
+
+def bench_completion(rounds):
+    shell = pynicom.Pynicom()
+    shell._cmd_dict = pynicom.get_commands(dictionary_lines(DICTIONARY_SIZES[-1]), {})
+    prefixes = ["at", "at+", "at+bench", "at+bench0999", "at+nomatch"]
+
+    def complete():
+        for line in prefixes:
+            shell.complete_at(line[2:], line, 2, len(line))
+
+    elapsed = min(measure(complete, rounds))
+    return {
+        "completion_latency_%d" % DICTIONARY_SIZES[-1]: result(
+            elapsed / len(prefixes), "s"
+        )
+    }
+
+
+def bench_nmea_checksum(rounds):
+    shell = pynicom.Pynicom()
+    count = 10000
+    elapsed = min(
+        measure(
+            lambda: [shell._Pynicom__nmea_checksum(NMEA_SENTENCE) for _ in range(count)],
+            rounds,
+        )
+    )
+    return {
+        "nmea_checksum_rate": result(count / elapsed, "sentences/s"),
+        "nmea_checksum_bytes_rate": result(count * len(NMEA_SENTENCE) / elapsed, "B/s"),
+    }
+
+
+def bench_cmux_deframe(rounds):
+    payload = NMEA_SENTENCE.encode()[:31]
+    frames = pynicom.cmux_frame(1, pynicom.CMUX_UIH, payload, 0) * 1000
+    received = []
+    mux = pynicom.Cmux(-1, on_data=lambda dlci, data: received.append(len(data)))
+
+    elapsed = min(measure(lambda: mux.feed(frames), rounds))
+    return {"cmux_deframe_rate": result(len(frames) / elapsed, "B/s")}
+
+
+def bench_cmux_pty(size):
+    """
+    Stream size bytes on DLC1 from a software CMUX peer on the master side of
+    a pty pair to the multiplexer on the slave side.
+    """
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    received = [0]
+
+    def count(dlci, data):
+        received[0] += len(data)
+
+    mux = pynicom.Cmux(slave, on_data=count)
+    peer = pynicom.Cmux(master, initiator=False)
+    threading.Thread(target=peer.run, daemon=True).start()
+
+    mux.open_channel(0)
+    mux.open_channel(1)
+    start = time.perf_counter()
+    threading.Thread(target=peer.send, args=(1, b"x" * size), daemon=True).start()
+    mux.wait(lambda: received[0] >= size, 30)
+    elapsed = time.perf_counter() - start
+    mux.close()
+    os.close(master)
+    os.close(slave)
+
+    return {"cmux_pty_rate": result(received[0] / elapsed, "B/s")}
+
+
+def compare(results, baseline_file):
+    baseline = json.load(open(baseline_file, "r"))["results"]
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]["value"]
+        new = results[name]["value"]
+        print(
+            "  %-32s %12.6g -> %12.6g %s (x%.2f)"
+            % (name, old, new, results[name]["unit"], new / old if old else 0)
+        )
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments["-d"] or arguments["--debug"]:
+        pynicom.set_debug(True)
+    else:
+        logging.getLogger("pynicom").setLevel(logging.ERROR)
+
+    timeout = float(arguments["--timeout"])
+    rounds = int(arguments["--rounds"])
+
+    responder = ScriptedResponder({"AT+GMR": ["1.2.3", "OK"]}, not arguments["--no-echo"])
+    responder.start()
+    shell = new_shell(responder.port, timeout)
+
+    results = {}
+    results.update(bench_round_trip(shell, rounds))
+    results.update(bench_rx(shell, int(arguments["--lines"]), timeout))
+    results.update(bench_serial_write(shell, rounds))
+    results.update(bench_dictionary(rounds))
+    results.update(bench_completion(rounds))
+    results.update(bench_nmea_checksum(rounds))
+    results.update(bench_cmux_deframe(rounds))
+    results.update(bench_cmux_pty(1024 * 1024))
+
+    shell.connection.close()
+    responder.close()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "serial_timeout": timeout,
+        "echo": not arguments["--no-echo"],
+        "rounds": rounds,
+        "results": results,
+    }
+    json.dump(report, open(arguments["--output"], "w"), indent=2, sort_keys=True)
+
+    for name in sorted(results):
+        print("  %-32s %12.6g %s" % (name, results[name]["value"], results[name]["unit"]))
+
+    if arguments["--compare"]:
+        print("compared with %s" % arguments["--compare"])
+        compare(results, arguments["--compare"])
+
+
+if __name__ == "__main__":
+    main()
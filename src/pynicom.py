@@ -4,17 +4,32 @@ A Minicom like shell in Python
 author: Carlo Lobrano
 
 Usage:
-    pynicom [-d|--debug] [--port=port --baud=rate --bytesize=bytesize --parity=parity --stopbits=stopbits --sw-flow-ctrl=xonxoff --hw-rts-cts=rtscts --hw-dsr-dtr=dsrdtr --timeout=timeout] [--atcmd=atcmd]
+    pynicom [-d|--debug] [--port=port --baud=rate --bytesize=bytesize --parity=parity --stopbits=stopbits --sw-flow-ctrl=xonxoff --hw-rts-cts=rtscts --hw-dsr-dtr=dsrdtr --timeout=timeout] [--atcmd=atcmd] [--cache]
+    pynicom fleet <script> <port>... [-d|--debug] [--baud=rate] [--timeout=timeout] [--device-timeout=seconds] [--retries=retries] [--jobs=jobs] [--report=report] [--cache]
+
+Fleet mode runs the pynicom commands in <script> against every <port> in
+parallel, one worker process per port, and writes a JSON (or CSV, if the
+report file name ends with .csv) report of the per-device results.
 
 """
 
 import os
 from cmd import Cmd
 import glob
+import json
 import logging
+import multiprocessing
+import multiprocessing.connection
+import pty
+import re
 import readline as rl
+import select
+import socket
 import sys
+import time
+import tty
 import errno
+import csv
 from docopt import docopt
 import serial
 
@@ -39,6 +54,33 @@ HOME = os.path.expanduser("~")
 HISTORY = os.path.join(HOME, ".pynicom-history")
 _ROOT = os.path.abspath(os.path.dirname(__file__))
 DICTIONARY = os.path.join(_ROOT, "data", ".pynicom-dictionary")
+# Dictionary entries can declare how long (in seconds) their response can be
+# cached, e.g. "ATI  # Identification information [ttl=3600]"
+CACHE_TTL_RE = re.compile(r"\s*\[ttl=(\d+)\]")
+PASSTHROUGH_BUFSIZE = 65536
+ESCAPE_SEQUENCE = b"+++"
+
+# 3GPP 27.010 basic mode multiplexer
+CMUX_FLAG = 0xF9
+CMUX_FRAME_SIZE = 31  # default N1, the maximum info length of a frame
+CMUX_PF = 0x10
+CMUX_SABM = 0x2F
+CMUX_UA = 0x63
+CMUX_DM = 0x0F
+CMUX_DISC = 0x43
+CMUX_UIH = 0xEF
+CMUX_UI = 0x03
+# DLC0 control messages type (C/R and EA bits set apart)
+CMUX_CLD = 0xC0
+CMUX_MSC = 0xE0
+CMUX_MAX_FRAME_SIZE = 32768
+CMUX_MAX_DLCI = 63
+# AT+CMUX <port_speed> values
+CMUX_PORT_SPEEDS = {9600: 1, 19200: 2, 38400: 3, 57600: 4, 115200: 5, 230400: 6}
+# V.24 signals sent with MSC: EA, RTC and RTR on
+CMUX_V24_SIGNALS = 0x0D
+# data kept for a channel whose reader is slow, before dropping it
+CMUX_CHANNEL_BUFSIZE = 1024 * 1024
 
 LOGD('Dictionary location is "%s"', DICTIONARY)
 
@@ -64,8 +106,16 @@ class Pynicom(Cmd):
     ]
     PROMPT_FMT = "(%s@%d) "
     PROMPT_DEF = "(no-conn) "
+    # Commands that change the device state, making the cached responses stale
+    CACHE_INVALIDATE = ["AT&F", "AT&W", "ATZ", "AT#USBCFG"]
 
     _cmd_dict = {}
+    _cache_ttl = {}
+    _pending_cache_key = None
+    cache_enabled = False
+    last_result = None
+    last_result_time = None
+    quiet = False
     connection = None
     last_serial_read = None
     last_serial_write = None
@@ -82,6 +132,11 @@ class Pynicom(Cmd):
         "timeout": 1.0,
     }
 
+    def __init__(self, *args, **kwargs):
+        Cmd.__init__(self, *args, **kwargs)
+        self._response_cache = {}
+        self.last_response = []
+
     def do_dictionary(self, string=None):
         """
         If no keyword is provided, it shows all the known commands. If a keyword
@@ -166,6 +221,7 @@ class Pynicom(Cmd):
                 self._port_config["timeout"] = float(arg)
 
         LOGD("Connecting with the following params {0}.".format(self._port_config))
+        self.clear_cache(self._port_config["port"])
 
         try:
             self.connection = serial.Serial(
@@ -211,6 +267,7 @@ class Pynicom(Cmd):
         Set serial device fullpath for the connection
         """
         if self.__is_valid_connection():
+            self.clear_cache(self.connection.port)
             try:
                 self.connection.port = string
                 self.prompt = self.__set_prompt()
@@ -279,15 +336,19 @@ class Pynicom(Cmd):
         """
 
         allowed_zero_read = 3
+        self.last_response = []
+        self.last_result = None
+        self.last_result_time = None
 
         while allowed_zero_read > 0 or "nostop" in mode:
             try:
+                line = self.connection.readline()
                 if not PYTHON3:
                     LOGD("reading without decode")
-                    read = self.connection.readline().rstrip()
+                    read = line.rstrip()
                 else:
                     LOGD("reading with decode")
-                    read = self.connection.readline().decode().rstrip()
+                    read = line.decode().rstrip()
 
                 LOGD('got "%s"', read)
 
@@ -295,6 +356,10 @@ class Pynicom(Cmd):
                     LOGD("Got echo (%s)", read)
                     continue
 
+                if "OK" == read or "ERROR" in read:
+                    self.last_result = read
+                    self.last_result_time = time.time()
+
                 if len(read):
                     if (
                         None != self.last_serial_write
@@ -304,7 +369,13 @@ class Pynicom(Cmd):
                         continue
                     else:
                         self.last_serial_read = read
-                        print("%s%s" % (" " * len(self.prompt), read))
+                        self.last_response.append(read)
+                        if not self.quiet:
+                            print("%s%s" % (" " * len(self.prompt), read))
+                elif len(line):
+                    # the empty lines that frame V.25ter responses are not
+                    # zero reads
+                    continue
                 elif 0 < allowed_zero_read:
                     LOGD("stop read counter %d", allowed_zero_read)
                     allowed_zero_read -= 1
@@ -363,12 +434,14 @@ class Pynicom(Cmd):
         if self.toread:
             self.do_serial_read("")
             self.toread = False
+            self.__store_cached_response()
         return stop
 
     def do_serial_close(self, string=""):
         """Close serial connection (if any)"""
 
         if self.__is_valid_connection():
+            self.clear_cache(self.connection.port)
             self.connection.close()
             self.prompt = self.PROMPT_DEF
             self._port_config = {
@@ -423,6 +496,160 @@ class Pynicom(Cmd):
     def complete_set_debug(self, text, line, begidx, endidx):
         completions = ["False", "True"]
 
+    def do_passthrough(self, string=""):
+        """
+        Bridge the serial device to a local pty (default) or socket to carry a
+        data mode session, e.g. pppd after ATD*99#. Bytes are copied unchanged in
+        both directions. Press CTRL-C, or send +++ from the local side between
+        two guard times of silence, to go back to command mode.
+
+        Example:
+        passthrough [pty|tcp:<host>:<port>|unix:<path>] [guard_time]
+        """
+        if not self.__is_valid_connection():
+            return
+
+        args = string.split()
+        target = args[0] if 0 < len(args) else "pty"
+        try:
+            guard_time = float(args[1]) if 1 < len(args) else 1.0
+        except ValueError:
+            guard_time = -1
+
+        if not 0 <= guard_time < float("inf"):
+            LOGE("Wrong argument %s (expected a guard time in seconds)", string)
+            return
+
+        try:
+            peer = open_passthrough_peer(target)
+        except (ValueError, IOError, OSError) as err:
+            LOGE('Could not open passthrough peer "%s": %s', target, err)
+            return
+        except KeyboardInterrupt:
+            LOGW("Keyboard interrupt")
+            return
+
+        stats = bridge(self.connection.fileno(), peer, guard_time)
+        peer["close"]()
+
+        if "escape" != stats["reason"]:
+            # the modem did not see the escape sequence, send it now
+            try:
+                time.sleep(guard_time)
+                write_all(self.connection.fileno(), ESCAPE_SEQUENCE)
+                time.sleep(guard_time)
+            except (IOError, OSError) as err:
+                LOGE("Could not send the escape sequence: %s", err)
+            except KeyboardInterrupt:
+                LOGW("Keyboard interrupt")
+
+        print(
+            "passthrough closed (%s): rx %d bytes (%.0f B/s), tx %d bytes (%.0f B/s) in %.1fs"
+            % (
+                stats["reason"],
+                stats["rx"],
+                stats["rx"] / stats["elapsed"],
+                stats["tx"],
+                stats["tx"] / stats["elapsed"],
+                stats["elapsed"],
+            )
+        )
+        self.last_serial_write = None
+        self.toread = True
+
+    def complete_passthrough(self, text, line, begidx, endidx):
+        return [arg for arg in ["pty", "tcp:", "unix:"] if arg.startswith(text)]
+
+    def do_cmux(self, string=""):
+        """
+        Start the 3GPP 27.010 multiplexer with AT+CMUX and expose each virtual
+        channel (DLC) as a pty, so that e.g. NMEA can be read on one of them
+        while another pynicom session sends AT commands on another. Press
+        CTRL-C to close the multiplexer and go back to command mode.
+
+        Example:
+        cmux [channels] [frame_size]
+
+        channels (1-63) defaults to 2, frame_size (N1, 1-32768) to 31. A
+        different frame size is sent to the device with AT+CMUX=0,0,<speed>,<N1>,
+        so the baud rate must be a standard port speed (9600-230400).
+        """
+        if not self.__is_valid_connection():
+            return
+
+        args = string.split()
+        try:
+            channels = int(args[0]) if 0 < len(args) else 2
+            frame_size = int(args[1]) if 1 < len(args) else CMUX_FRAME_SIZE
+        except ValueError:
+            channels = frame_size = 0
+
+        if not 1 <= channels <= CMUX_MAX_DLCI or not 1 <= frame_size <= CMUX_MAX_FRAME_SIZE:
+            LOGE(
+                "Wrong argument %s (expected channels 1-%d and frame size 1-%d)",
+                string,
+                CMUX_MAX_DLCI,
+                CMUX_MAX_FRAME_SIZE,
+            )
+            return
+
+        cmd = "AT+CMUX=0"
+        if CMUX_FRAME_SIZE != frame_size:
+            speed = CMUX_PORT_SPEEDS.get(int(self.connection.baudrate))
+            if None == speed:
+                LOGE("Frame size %d needs a standard baud rate", frame_size)
+                return
+            cmd = "AT+CMUX=0,0,%d,%d" % (speed, frame_size)
+
+        self.serial_write(cmd)
+        self.do_serial_read("")
+        self.toread = False
+        if "OK" != self.last_result:
+            LOGE("The device did not accept %s", cmd)
+            return
+
+        mux = Cmux(self.connection.fileno(), frame_size=frame_size)
+        ptys = []
+        try:
+            if not mux.open_channel(0):
+                LOGE("Could not open the multiplexer control channel")
+                return
+
+            for dlci in range(1, channels + 1):
+                if not mux.open_channel(dlci):
+                    LOGE("Could not open DLC%d", dlci)
+                    continue
+
+                master, slave = pty.openpty()
+                tty.setraw(slave)
+                os.set_blocking(master, False)
+                ptys.append((master, slave))
+                mux.attach(dlci, master)
+                print("DLC%d on %s" % (dlci, os.ttyname(slave)))
+
+            mux.run()
+        except KeyboardInterrupt:
+            LOGW("Keyboard interrupt")
+        except (IOError, OSError) as err:
+            LOGE("Multiplexer link lost: %s", err)
+            mux.running = False
+            mux.opened.clear()
+        finally:
+            # a lost link cannot do the close down handshake
+            if mux.opened:
+                try:
+                    mux.close()
+                except (IOError, OSError) as err:
+                    LOGE("Could not close down the multiplexer: %s", err)
+            for master, slave in ptys:
+                os.close(master)
+                os.close(slave)
+
+        for dlci in sorted(mux.rx):
+            print("  DLC%d: rx %d bytes, tx %d bytes" % (dlci, mux.rx[dlci], mux.tx[dlci]))
+        if mux.errors or mux.dropped:
+            LOGW("%d bad frames, %d bytes dropped", mux.errors, mux.dropped)
+
     def do_nmea(self, string):
         sentence = self.__nmea_format(string)
         print('nmea > "$%s<CR><LF>"' % sentence)
@@ -445,7 +672,69 @@ class Pynicom(Cmd):
         """
         pass
 
+    def do_cache(self, string=""):
+        """
+        Inspect or control the response cache of idempotent query commands.
+        Only the commands with a [ttl=<seconds>] tag in the dictionary are cached.
+        Responses are kept per port for the current connection only: they are
+        dropped when the port is (re)opened, changed or closed.
+
+        cache               show cache status and cached responses
+        cache on|off        enable/disable the cache
+        cache clear         drop all cached responses
+        cache bypass <cmd>  send <cmd> to the device refreshing its cached response
+        """
+        args = string.split(" ", 1)
+
+        if self.__is_string_empty(string):
+            print("  cache %s" % ("on" if self.cache_enabled else "off"))
+            now = time.time()
+            for (port, cmd), (stored, ttl, lines) in self._response_cache.items():
+                print("  %s %s (age %ds, ttl %ds)" % (port, cmd, now - stored, ttl))
+                for line in lines:
+                    print("    %s" % line)
+
+        elif "on" == args[0].lower():
+            self.cache_enabled = True
+
+        elif "off" == args[0].lower():
+            self.cache_enabled = False
+
+        elif "clear" == args[0].lower():
+            self.clear_cache()
+            LOGI("cache cleared")
+
+        elif "bypass" == args[0].lower() and 2 == len(args):
+            if self.__is_valid_connection():
+                key = self.__cache_key(args[1])
+                if None != key:
+                    self._response_cache.pop(key, None)
+                self.serial_write(args[1].strip())
+
+        else:
+            LOGE("Wrong argument %s (expected 'on', 'off', 'clear' or 'bypass <cmd>')", string)
+
+    def complete_cache(self, text, line, begidx, endidx):
+        return [arg for arg in ["bypass", "clear", "off", "on"] if arg.startswith(text)]
+
+    def clear_cache(self, port=None):
+        """Drop the cached responses of the given port, or of all ports"""
+        if None == port:
+            self._response_cache = {}
+        else:
+            self._response_cache = dict(
+                (key, entry)
+                for key, entry in self._response_cache.items()
+                if key[0] != port
+            )
+
     def serial_write(self, msg, appendix="\r"):
+        key = self.__cache_key(msg)
+        if None != key and self.__replay_cached_response(key):
+            return
+
+        self.__invalidate_cache_on(msg)
+
         try:
             msg_cr = msg + appendix
             LOGD('sending: "%s"', repr(msg_cr))
@@ -462,6 +751,7 @@ class Pynicom(Cmd):
             else:
                 self.last_serial_write = msg
                 self.toread = True
+                self._pending_cache_key = key
 
         except (TypeError) as err:
             LOGE('Could not write msg "%s": %s', msg, err)
@@ -474,6 +764,61 @@ class Pynicom(Cmd):
             retval = False
         return retval
 
+    def __cache_key(self, msg):
+        if not self.cache_enabled or not self.__is_valid_connection():
+            return None
+
+        cmd = msg.strip().upper()
+        if cmd not in self._cache_ttl:
+            return None
+
+        return (self.connection.port, cmd)
+
+    def __replay_cached_response(self, key):
+        if key not in self._response_cache:
+            return False
+
+        stored, ttl, lines = self._response_cache[key]
+        if time.time() - stored > ttl:
+            LOGD("Cached response for %s expired", key[1])
+            del self._response_cache[key]
+            return False
+
+        LOGD("Replaying cached response for %s", key[1])
+        self.last_response = list(lines)
+        self.last_result = "OK"
+        self.last_result_time = time.time()
+        if not self.quiet:
+            for line in lines:
+                print("%s%s" % (" " * len(self.prompt), line))
+        return True
+
+    def __store_cached_response(self):
+        key = self._pending_cache_key
+        self._pending_cache_key = None
+
+        if None == key or 0 == len(self.last_response):
+            return
+
+        if [line for line in self.last_response if "ERROR" in line]:
+            LOGD("Not caching error response for %s", key[1])
+            return
+
+        LOGD("Caching response for %s", key[1])
+        self._response_cache[key] = (
+            time.time(),
+            self._cache_ttl[key[1]],
+            list(self.last_response),
+        )
+
+    def __invalidate_cache_on(self, msg):
+        cmd = msg.strip().upper()
+        for state_cmd in self.CACHE_INVALIDATE:
+            if cmd.startswith(state_cmd):
+                LOGD("%s changes the device state, invalidating cache", cmd)
+                self.clear_cache(self.connection.port)
+                break
+
     def __send_raw(self, string=""):
         """Let the user send raw messages to the serial device"""
         if self.__is_valid_connection():
@@ -533,7 +878,458 @@ class Pynicom(Cmd):
             LOGE("Highlightning not available. Raffaello module not found")
 
 
-def get_commands(string_list):
+def write_all(fd, data):
+    """Write all data to a (possibly non blocking) file descriptor"""
+    data = memoryview(data)
+    while len(data):
+        try:
+            data = data[os.write(fd, data) :]
+        except (BlockingIOError, InterruptedError):
+            select.select([], [fd], [])
+
+
+def write_some(fd, data):
+    """Write data to a non blocking file descriptor, return the bytes written"""
+    try:
+        return os.write(fd, data)
+    except (BlockingIOError, InterruptedError):
+        return 0
+
+
+def open_passthrough_peer(target):
+    """
+    Open the local side of a passthrough bridge. target is "pty",
+    "tcp:<host>:<port>" or "unix:<path>". Return a dict with the peer non
+    blocking fileno and its read_into, write and close functions.
+    """
+    if "pty" == target:
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        print("passthrough on %s, waiting for a client" % os.ttyname(slave))
+
+        # without the slave open, the master reports the client hangup
+        os.close(slave)
+        poller = select.poll()
+        poller.register(master, select.POLLIN)
+        try:
+            while [event for fd, event in poller.poll(100) if event & select.POLLHUP]:
+                # poll returns POLLHUP at once until the client opens the slave
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            os.close(master)
+            raise
+
+        def read_into(buf):
+            try:
+                return os.readv(master, [buf])
+            except OSError as err:
+                if errno.EIO == err.errno:
+                    return 0
+                raise
+
+        return {
+            "fileno": master,
+            "read_into": read_into,
+            "write": lambda data: write_some(master, data),
+            "close": lambda: os.close(master),
+        }
+
+    if target.startswith("tcp:"):
+        host, port = target[len("tcp:") :].rsplit(":", 1)
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, int(port)))
+    elif target.startswith("unix:"):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(target[len("unix:") :])
+    else:
+        raise ValueError("unknown target (expected pty, tcp:<host>:<port> or unix:<path>)")
+
+    server.listen(1)
+    print("passthrough waiting for a connection on %s" % target)
+    try:
+        client = server.accept()[0]
+    finally:
+        server.close()
+        if target.startswith("unix:"):
+            os.unlink(target[len("unix:") :])
+
+    client.setblocking(False)
+
+    def send(data):
+        try:
+            return client.send(data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    return {
+        "fileno": client.fileno(),
+        "read_into": client.recv_into,
+        "write": send,
+        "close": client.close,
+    }
+
+
+def bridge(serial_fd, peer, guard_time=1.0):
+    """
+    Copy bytes between the serial device and the passthrough peer until CTRL-C,
+    one side hangs up or the peer sends the escape sequence between two guard
+    times. Each direction has its own reusable buffer, which is read again only
+    once the other side has taken all of it, so a slow side never blocks the
+    other direction. Return the rx (serial to peer) and tx (peer to serial)
+    byte counters, the elapsed time and the reason why the bridge stopped.
+    """
+    stats = {"rx": 0, "tx": 0, "elapsed": 0.0, "reason": "interrupted"}
+    rx_buf = memoryview(bytearray(PASSTHROUGH_BUFSIZE))
+    tx_buf = memoryview(bytearray(PASSTHROUGH_BUFSIZE))
+    rx_pending = rx_buf[:0]
+    tx_pending = tx_buf[:0]
+    peer_fd = peer["fileno"]
+    start = last_tx = time.time()
+    escape_count = 0
+
+    try:
+        while True:
+            timeout = None
+            if len(ESCAPE_SEQUENCE) == escape_count:
+                timeout = max(last_tx + guard_time - time.time(), 0)
+                if 0 == timeout:
+                    stats["reason"] = "escape"
+                    break
+
+            readers = []
+            writers = []
+            if len(rx_pending):
+                writers.append(peer_fd)
+            else:
+                readers.append(serial_fd)
+            if len(tx_pending):
+                writers.append(serial_fd)
+            else:
+                readers.append(peer_fd)
+
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+            now = time.time()
+
+            if serial_fd in readable:
+                read = os.readv(serial_fd, [rx_buf])
+                if 0 == read:
+                    stats["reason"] = "serial hangup"
+                    break
+                rx_pending = rx_buf[:read]
+                stats["rx"] += read
+
+            if peer_fd in readable:
+                read = peer["read_into"](tx_buf)
+                if 0 == read:
+                    stats["reason"] = "peer hangup"
+                    break
+
+                # +++ counts as escape only if surrounded by guard_time silence
+                if (
+                    escape_count + read <= len(ESCAPE_SEQUENCE)
+                    and tx_buf[:read] == ESCAPE_SEQUENCE[escape_count : escape_count + read]
+                    and (0 < escape_count or now - last_tx >= guard_time)
+                ):
+                    escape_count += read
+                else:
+                    escape_count = 0
+
+                tx_pending = tx_buf[:read]
+                stats["tx"] += read
+                last_tx = now
+
+            if peer_fd in writable:
+                rx_pending = rx_pending[peer["write"](rx_pending) :]
+
+            if serial_fd in writable:
+                tx_pending = tx_pending[write_some(serial_fd, tx_pending) :]
+
+        # do not lose what is already read, unless its destination hung up
+        if "peer hangup" != stats["reason"]:
+            write_all(peer_fd, rx_pending)
+        if "serial hangup" != stats["reason"]:
+            write_all(serial_fd, tx_pending)
+
+    except KeyboardInterrupt:
+        LOGW("Keyboard interrupt")
+    except (OSError, IOError) as err:
+        LOGE(err)
+        stats["reason"] = "error"
+
+    stats["elapsed"] = max(time.time() - start, 1e-6)
+    return stats
+
+
+def _cmux_fcs_table():
+    # CRC-8 with reversed polynomial x^8 + x^2 + x + 1
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xE0 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CMUX_FCS_TABLE = _cmux_fcs_table()
+
+
+def cmux_fcs(data):
+    """Return the 27.010 frame check sequence of data"""
+    crc = 0xFF
+    for byte in data:
+        crc = CMUX_FCS_TABLE[crc ^ byte]
+    return 0xFF - crc
+
+
+def cmux_frame(dlci, control, info=b"", cr=1):
+    """Build a 27.010 basic mode frame"""
+    header = bytearray([(dlci << 2) | (cr << 1) | 1, control])
+    if len(info) <= 127:
+        header.append((len(info) << 1) | 1)
+    else:
+        header += bytearray([(len(info) << 1) & 0xFE, len(info) >> 7])
+
+    # UIH frames do not protect the info field
+    if CMUX_UIH == control & ~CMUX_PF:
+        fcs = cmux_fcs(header)
+    else:
+        fcs = cmux_fcs(header + info)
+
+    return bytes(bytearray([CMUX_FLAG]) + header + info + bytearray([fcs, CMUX_FLAG]))
+
+
+class Cmux(object):
+    """
+    3GPP 27.010 basic mode multiplexer over a serial file descriptor.
+
+    The initiator (the default) opens the channels towards the device, while
+    initiator=False makes it a responder, i.e. a software device accepting
+    every channel, useful to exercise the multiplexer against a pty. Channel
+    data goes to the file descriptor attached to the DLC or, if none, to the
+    on_data(dlci, data) callback.
+    """
+
+    def __init__(self, serial_fd, initiator=True, frame_size=CMUX_FRAME_SIZE, on_data=None):
+        self.serial_fd = serial_fd
+        self.initiator = initiator
+        self.frame_size = frame_size
+        self.on_data = on_data
+        self.running = True
+        self.opened = set()
+        self.refused = set()
+        self.closing = set()
+        self.channel_fds = {}
+        self.fd_channels = {}
+        self.pending = {}
+        self.rx = {}
+        self.tx = {}
+        self.errors = 0
+        self.dropped = 0
+        self._buffer = bytearray()
+        self._read_buf = memoryview(bytearray(PASSTHROUGH_BUFSIZE))
+
+    def attach(self, dlci, fd):
+        """Bridge the DLC to a (non blocking) file descriptor, e.g. a pty master"""
+        self.channel_fds[dlci] = fd
+        self.fd_channels[fd] = dlci
+        self.pending[dlci] = bytearray()
+
+    def write_frame(self, dlci, control, info=b"", command=True):
+        # C/R is set on the initiator commands and on the responder responses
+        cr = 1 if command == self.initiator else 0
+        write_all(self.serial_fd, cmux_frame(dlci, control, info, cr))
+
+    def send(self, dlci, data):
+        """Send data on the DLC, split in UIH frames of frame_size at most"""
+        data = memoryview(data)
+        for start in range(0, len(data), self.frame_size):
+            self.write_frame(dlci, CMUX_UIH, data[start : start + self.frame_size].tobytes())
+        self.tx[dlci] = self.tx.get(dlci, 0) + len(data)
+
+    def open_channel(self, dlci, timeout=3.0):
+        """Send SABM and wait for the device to accept the DLC"""
+        self.refused.discard(dlci)
+        self.write_frame(dlci, CMUX_SABM | CMUX_PF)
+        self.wait(lambda: dlci in self.opened or dlci in self.refused, timeout)
+
+        if 0 != dlci and dlci in self.opened:
+            self.rx.setdefault(dlci, 0)
+            self.tx.setdefault(dlci, 0)
+            msc = bytearray([CMUX_MSC | 0x03, 0x05, (dlci << 2) | 0x03, CMUX_V24_SIGNALS])
+            self.write_frame(0, CMUX_UIH, bytes(msc))
+
+        return dlci in self.opened
+
+    def close(self, timeout=1.0):
+        """Disconnect all the DLCs and close down the multiplexer"""
+        for dlci in sorted(self.opened - set([0]), reverse=True):
+            self.closing.add(dlci)
+            self.write_frame(dlci, CMUX_DISC | CMUX_PF)
+            self.wait(lambda: dlci not in self.opened, timeout)
+
+        self.running = True
+        self.write_frame(0, CMUX_UIH, bytes(bytearray([CMUX_CLD | 0x03, 0x01])))
+        self.wait(lambda: not self.running, timeout)
+        self.running = False
+        self.opened.clear()
+
+    def wait(self, condition, timeout):
+        deadline = time.time() + timeout
+        while not condition():
+            remaining = deadline - time.time()
+            if 0 >= remaining:
+                break
+            self.poll(remaining)
+
+    def run(self):
+        """Move data between the serial device and the channels until close down"""
+        while self.running:
+            self.poll(None)
+
+    def poll(self, timeout):
+        writers = [self.channel_fds[dlci] for dlci in self.pending if self.pending[dlci]]
+        readable, writable, _ = select.select(
+            [self.serial_fd] + list(self.fd_channels), writers, [], timeout
+        )
+
+        for fd in writable:
+            pending = self.pending[self.fd_channels[fd]]
+            del pending[: write_some(fd, pending)]
+
+        for fd in readable:
+            read = os.readv(fd, [self._read_buf])
+            if fd == self.serial_fd:
+                if 0 == read:
+                    raise IOError("serial device hung up")
+                self.feed(self._read_buf[:read])
+            elif 0 < read:
+                self.send(self.fd_channels[fd], self._read_buf[:read])
+
+    def feed(self, data):
+        """Deframe the bytes received from the serial device"""
+        buf = self._buffer
+        buf += data
+        pos = 0
+
+        while True:
+            start = buf.find(CMUX_FLAG, pos)
+            if 0 > start:
+                pos = len(buf)
+                break
+
+            # consecutive frames may share the same flag
+            while start + 1 < len(buf) and CMUX_FLAG == buf[start + 1]:
+                start += 1
+
+            header_len = 3 if len(buf) - start > 3 and buf[start + 3] & 1 else 4
+            if len(buf) - start < header_len + 3:
+                pos = start
+                break
+
+            length = buf[start + 3] >> 1
+            if 4 == header_len:
+                length |= buf[start + 4] << 7
+
+            fcs_pos = start + 1 + header_len + length
+            if length > max(self.frame_size, 127):
+                LOGD("cmux: bad frame length %d", length)
+                self.errors += 1
+                pos = start + 1
+                continue
+
+            if fcs_pos + 1 >= len(buf):
+                pos = start
+                break
+
+            header = buf[start + 1 : start + 1 + header_len]
+            info = bytes(buf[start + 1 + header_len : fcs_pos])
+            control = header[1]
+            if CMUX_UIH == control & ~CMUX_PF:
+                fcs = cmux_fcs(header)
+            else:
+                fcs = cmux_fcs(header + info)
+
+            if CMUX_FLAG != buf[fcs_pos + 1] or fcs != buf[fcs_pos]:
+                LOGD("cmux: bad frame at %d", start)
+                self.errors += 1
+                pos = start + 1
+                continue
+
+            self.handle_frame(header[0] >> 2, control & ~CMUX_PF, info)
+            # keep the closing flag, it can be the opening flag of the next frame
+            pos = fcs_pos + 1
+
+        del buf[:pos]
+
+    def handle_frame(self, dlci, control, info):
+        LOGD("cmux: DLC%d control 0x%02X, %d bytes", dlci, control, len(info))
+
+        if CMUX_SABM == control:
+            self.opened.add(dlci)
+            self.write_frame(dlci, CMUX_UA | CMUX_PF, command=False)
+
+        elif CMUX_UA == control:
+            if dlci in self.closing:
+                self.closing.discard(dlci)
+                self.opened.discard(dlci)
+            else:
+                self.opened.add(dlci)
+
+        elif CMUX_DM == control:
+            self.closing.discard(dlci)
+            self.opened.discard(dlci)
+            self.refused.add(dlci)
+
+        elif CMUX_DISC == control:
+            self.opened.discard(dlci)
+            self.write_frame(dlci, CMUX_UA | CMUX_PF, command=False)
+
+        elif control in (CMUX_UIH, CMUX_UI):
+            if 0 == dlci:
+                self.handle_control(info)
+            else:
+                self.deliver(dlci, info)
+
+    def handle_control(self, info):
+        if 2 > len(info):
+            return
+
+        msg_type = bytearray(info)[0]
+        if msg_type & 0x02:
+            # commands are answered echoing their value
+            reply = bytearray(info)
+            reply[0] = msg_type & ~0x02
+            self.write_frame(0, CMUX_UIH, bytes(reply))
+
+        if CMUX_CLD == msg_type & ~0x03:
+            self.running = False
+            if msg_type & 0x02:
+                self.opened.clear()
+
+    def deliver(self, dlci, data):
+        self.rx[dlci] = self.rx.get(dlci, 0) + len(data)
+        if dlci in self.channel_fds:
+            pending = self.pending[dlci]
+            if not pending:
+                data = data[write_some(self.channel_fds[dlci], data) :]
+
+            # like a UART without a reader, a channel nobody reads loses data
+            room = CMUX_CHANNEL_BUFSIZE - len(pending)
+            pending += data[:room]
+            self.dropped += max(len(data) - room, 0)
+        elif None != self.on_data:
+            self.on_data(dlci, data)
+
+
+def get_commands(string_list, ttls=None):
+    """
+    Parse the dictionary lines into a {command: short help} dict. If ttls is
+    given, it is filled with {COMMAND: seconds} for the commands declaring a
+    [ttl=<seconds>] tag.
+    """
     if 0 == len(string_list):
         LOGE("No data to generate known command list")
         return
@@ -568,6 +1364,12 @@ def get_commands(string_list):
 
             at_cmd = string.strip()
             at_key = string[2]
+
+            ttl = CACHE_TTL_RE.search(short_help)
+            if None != ttl:
+                short_help = CACHE_TTL_RE.sub("", short_help)
+                if None != ttls:
+                    ttls[at_cmd.upper()] = int(ttl.group(1))
             cmd = string[3:].strip()
 
             LOGD("adding %s to dict for at%s", at_cmd, at_key)
@@ -584,7 +1386,8 @@ def stub_do_func(instance, string):
     if (None == instance.connection) or (not instance.connection.isOpen()):
         LOGI("No serial connection established yet")
     else:
-        cmd = "%s" % string
+        # string holds only the arguments, Cmd keeps the whole line in lastcmd
+        cmd = "%s" % instance.lastcmd
         instance.serial_write(cmd)
 
 
@@ -625,29 +1428,37 @@ def run(shell):
         shell.do_serial_close("")
 
 
-def init(arguments={}):
-    """Initialize list of known commands and pynicom shell"""
-    shell = Pynicom()
-
+def load_dictionary(shell):
+    """Load the known commands from the dictionary file into the shell"""
     try:
         if not os.path.exists(DICTIONARY):
             LOGW("Could not find dictionary at '%s'", DICTIONARY)
 
         else:
             LOGI("Loading dictionary %s", DICTIONARY)
-            known_commands = get_commands(open(DICTIONARY, "r").readlines())
+            cache_ttls = {}
+            known_commands = get_commands(
+                open(DICTIONARY, "r").readlines(), cache_ttls
+            )
 
             if len(known_commands) == 0:
                 LOGW("No commands in dictionary file %s", DICTIONARY)
             else:
                 add_do_command(known_commands, Pynicom)
                 shell._cmd_dict = known_commands
+                shell._cache_ttl = cache_ttls
                 LOGI("Dictionary loaded")
     except IOError as err:
         if errno.ENOENT != err.errno:
             LOGE("IOERROR accessing %s: %s", DICTIONARY, err)
             sys.exit(1)
 
+
+def init(arguments={}):
+    """Initialize list of known commands and pynicom shell"""
+    shell = Pynicom()
+    load_dictionary(shell)
+
     connect_at_init = ""
 
     if arguments["--port"]:
@@ -685,6 +1496,9 @@ def init(arguments={}):
     else:
         connect_at_init += " "
 
+    if arguments["--cache"]:
+        shell.cache_enabled = True
+
     if 0 < len(connect_at_init):
         shell.do_serial_open(connect_at_init)
     else:
@@ -693,6 +1507,234 @@ def init(arguments={}):
     return shell
 
 
+def run_script(port, script, options):
+    """
+    Run the script commands against a single device and return the report of
+    each command. Raise IOError if the device cannot be opened. An exit/quit
+    command ends the script.
+    """
+    shell = Pynicom()
+    shell.quiet = True
+    shell.cache_enabled = options["cache"]
+    load_dictionary(shell)
+
+    # serial_open positional args: port baudrate ... timeout
+    shell.do_serial_open(
+        " ".join([port, options["baud"], "", "", "", "", "", "", options["timeout"]])
+    )
+    if None == shell.connection or not shell.connection.isOpen():
+        raise IOError("could not open %s" % port)
+
+    results = []
+    try:
+        for line in script:
+            # exit/quit would save the history and exit the worker
+            if shell.parseline(line)[0] in ("exit", "quit"):
+                break
+
+            shell.last_response = []
+            shell.last_result = None
+            shell.last_result_time = None
+            start = time.time()
+            stop = shell.onecmd(line)
+            wrote = shell.toread
+            shell.postcmd(stop, line)
+
+            # the response ends with the final result code, serial_read then
+            # waits for some empty reads that are not part of the latency.
+            # A cached response has a result code but nothing was written.
+            end = shell.last_result_time or time.time()
+            answered = wrote or None != shell.last_result
+            passed = not answered or "OK" == shell.last_result
+            results.append(
+                {
+                    "command": line,
+                    "status": "pass" if passed else "fail",
+                    "latency": end - start,
+                    "response": shell.last_response,
+                }
+            )
+    finally:
+        shell.connection.close()
+
+    return results
+
+
+def fleet_worker(port, attempt, script, options, pipe):
+    """Run the script once against a single device, send the report on pipe"""
+    report = {"port": port, "attempt": attempt, "commands": [], "error": None}
+    try:
+        report["commands"] = run_script(port, script, options)
+        failed = [cmd for cmd in report["commands"] if "fail" == cmd["status"]]
+        if 0 != len(failed):
+            report["error"] = "%d commands failed" % len(failed)
+    except (IOError, OSError, serial.SerialException) as err:
+        report["error"] = str(err)
+
+    pipe.send(report)
+    pipe.close()
+
+
+def write_fleet_report(reports, filename):
+    """Write the fleet reports as CSV (if filename ends with .csv) or JSON"""
+    with open(filename, "w") as report_file:
+        if filename.lower().endswith(".csv"):
+            fields = [
+                "port",
+                "status",
+                "attempts",
+                "elapsed",
+                "commands",
+                "failed",
+                "mean_latency",
+                "max_latency",
+                "error",
+            ]
+            writer = csv.DictWriter(report_file, fields)
+            writer.writeheader()
+            for report in reports:
+                latencies = [cmd["latency"] for cmd in report["commands"]]
+                writer.writerow(
+                    {
+                        "port": report["port"],
+                        "status": report["status"],
+                        "attempts": report["attempts"],
+                        "elapsed": "%.3f" % report["elapsed"],
+                        "commands": len(report["commands"]),
+                        "failed": len(
+                            [c for c in report["commands"] if "fail" == c["status"]]
+                        ),
+                        "mean_latency": "%.3f"
+                        % (sum(latencies) / len(latencies) if latencies else 0),
+                        "max_latency": "%.3f" % max(latencies + [0]),
+                        "error": report["error"] or "",
+                    }
+                )
+        else:
+            json.dump({"devices": reports}, report_file, indent=2)
+
+
+def fleet(arguments):
+    """Run a script on many devices in parallel. Return 0 if all of them pass"""
+    script = [
+        line.strip()
+        for line in open(arguments["<script>"], "r").readlines()
+        if line.strip() and not line.startswith("#")
+    ]
+    options = {
+        "baud": arguments["--baud"] or "115200",
+        "timeout": arguments["--timeout"] or "1.0",
+        "device_timeout": float(arguments["--device-timeout"] or 60),
+        "retries": int(arguments["--retries"] or 0),
+        "cache": arguments["--cache"],
+    }
+    ports = arguments["<port>"]
+    try:
+        jobs = int(arguments["--jobs"] or len(ports))
+    except ValueError:
+        jobs = 0
+    if 1 > jobs:
+        LOGE("Wrong --jobs %s (expected a number greater than 0)", arguments["--jobs"])
+        return 1
+    jobs = min(jobs, len(ports))
+
+    # two workers on the same device would mix their commands and responses
+    devices = [os.path.realpath(port) for port in ports]
+    duplicated = sorted(set(p for p, d in zip(ports, devices) if 1 < devices.count(d)))
+    if duplicated:
+        LOGE("Devices given more than once: %s", " ".join(duplicated))
+        return 1
+
+    LOGI("Running %d commands on %d devices", len(script), len(ports))
+    start = time.time()
+    reports = []
+    elapsed = dict((port, 0.0) for port in ports)
+    waiting = [(port, 1) for port in ports]
+    running = {}
+
+    def done(port, report):
+        process, started, attempt, pipe = running.pop(port)
+        pipe.close()
+        process.join()
+        elapsed[port] += time.time() - started
+
+        if report["error"] and attempt <= options["retries"]:
+            LOGW("%s attempt %d: %s", port, attempt, report["error"])
+            waiting.append((port, attempt + 1))
+            return
+
+        report.pop("attempt", None)
+        report["status"] = "fail" if report["error"] else "pass"
+        report["attempts"] = attempt
+        report["elapsed"] = elapsed[port]
+        print(
+            "%s %s (%d attempts, %.2fs)%s"
+            % (
+                report["status"].upper(),
+                port,
+                attempt,
+                report["elapsed"],
+                " " + report["error"] if report["error"] else "",
+            )
+        )
+        reports.append(report)
+
+    # One process per device, so that the device timeout can kill a blocked
+    # one. Each of them has its own pipe: a process killed while writing its
+    # report cannot corrupt the reports of the others.
+    try:
+        while waiting or running:
+            while waiting and len(running) < jobs:
+                port, attempt = waiting.pop(0)
+                pipe, worker_pipe = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=fleet_worker,
+                    args=(port, attempt, script, options, worker_pipe),
+                )
+                process.start()
+                worker_pipe.close()
+                running[port] = (process, time.time(), attempt, pipe)
+
+            pipes = dict((entry[3], port) for port, entry in running.items())
+            for pipe in multiprocessing.connection.wait(list(pipes), 0.1):
+                port = pipes[pipe]
+                process, started, attempt, _ = running[port]
+                try:
+                    report = pipe.recv()
+                except EOFError:
+                    process.join()
+                    error = "worker exited without a report"
+                    if 0 != process.exitcode:
+                        error = "worker exited with code %d" % process.exitcode
+                    report = {"port": port, "attempt": attempt, "commands": [], "error": error}
+
+                if report["port"] != port or report["attempt"] != attempt:
+                    LOGD("Ignoring stale report of %s", report["port"])
+                    continue
+                done(port, report)
+
+            now = time.time()
+            for port, (process, started, attempt, pipe) in list(running.items()):
+                if now - started > options["device_timeout"]:
+                    process.terminate()
+                    done(port, {"port": port, "commands": [], "error": "device timeout"})
+
+    except KeyboardInterrupt:
+        LOGW("Keyboard interrupt")
+        for process, started, attempt, pipe in running.values():
+            process.terminate()
+            process.join()
+            pipe.close()
+
+    passed = len([report for report in reports if "pass" == report["status"]])
+    print("%d/%d devices passed in %.2fs" % (passed, len(ports), time.time() - start))
+
+    if arguments["--report"]:
+        write_fleet_report(sorted(reports, key=lambda r: r["port"]), arguments["--report"])
+
+    return 0 if passed == len(ports) else 1
+
+
 def set_debug(debug=False):
     if debug:
         LOGGER.setLevel(logging.DEBUG)
@@ -713,6 +1755,9 @@ def main():
     arguments = docopt(__doc__)
     set_debug(arguments["-d"] or arguments["--debug"])
 
+    if arguments["fleet"]:
+        sys.exit(fleet(arguments))
+
     shell = init(arguments)
     run(shell)
 